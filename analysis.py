@@ -1,113 +1,212 @@
 # analysis.py
+import numpy as np
 import pandas as pd
-import plotly.express as px
+import plotly.graph_objects as go
 from scipy.stats import ttest_ind
 
+try:
+    from numba import njit, prange
+    NUMBA_AVAILABLE = True
+except ImportError:
+    # numba is optional; without it the NumPy path is always used
+    NUMBA_AVAILABLE = False
+
 CELL_POPULATIONS = ['b_cell', 'cd8_t_cell', 'cd4_t_cell', 'nk_cell', 'monocyte']
 
-def calculate_frequencies(df):
-    """Calculates total counts and relative frequencies for each cell population."""
-    df_copy = df.copy()
-    df_copy['total_count'] = df_copy[CELL_POPULATIONS].sum(axis=1)
+# Fixed-shape pieces of the long frequency table, built once rather than per call
+N_POPULATIONS = len(CELL_POPULATIONS)
+POPULATION_DTYPE = pd.CategoricalDtype(CELL_POPULATIONS)
+POPULATION_CODES = np.arange(N_POPULATIONS, dtype=np.int8)
+
+# Below this many samples the NumPy path is faster than dispatching to the numba kernel
+NUMBA_MIN_SAMPLES = 200_000
+
+if NUMBA_AVAILABLE:
+    @njit(parallel=True, cache=True)
+    def _freq_kernel(counts):
+        """Computes per-sample totals and percentages from an int64 (sample x population) counts matrix."""
+        n, k = counts.shape
+        totals = np.empty(n, dtype=np.int64)
+        pct = np.empty((n, k), dtype=np.float64)
+        for i in prange(n):
+            s = 0
+            for j in range(k):
+                s += counts[i, j]
+            totals[i] = s
+            # Same operation order as the NumPy path, (count / total) * 100, so both are bit-identical
+            for j in range(k):
+                pct[i, j] = counts[i, j] / s * 100.0 if s > 0 else 0.0
+        return totals, pct
+
+def calculate_frequencies(df, extra_id_vars=()):
+    """
+    Calculates total counts and relative frequencies for each cell population.
     
-    # Melt dataframe from wide to long format
-    long_df = pd.melt(
-        df_copy, 
-        id_vars=['sample_id', 'total_count'], 
-        value_vars=CELL_POPULATIONS,
-        var_name='population',
-        value_name='count'
-    )
+    Any columns named in extra_id_vars are carried through to the long output.
+    """
+    # Work on the wide (sample x population) counts matrix directly
+    counts = df[CELL_POPULATIONS].to_numpy()
     
-    # Calculate percentage and handle division by zero
-    long_df['percentage'] = long_df.apply(
-        lambda row: (row['count'] / row['total_count'] * 100) if row['total_count'] > 0 else 0,
-        axis=1
-    )
-    long_df = long_df.rename(columns={'sample_id': 'sample'})
-    return long_df[['sample', 'total_count', 'population', 'count', 'percentage']]
+    if NUMBA_AVAILABLE and len(df) >= NUMBA_MIN_SAMPLES:
+        totals, pct = _freq_kernel(counts.astype(np.int64, copy=False))
+    else:
+        totals = counts.sum(axis=1)
+        
+        # Calculate percentage and handle division by zero
+        pct = np.zeros(counts.shape, dtype=np.float64)
+        np.divide(counts, totals[:, None], out=pct, where=totals[:, None] > 0)
+        pct *= 100
+    
+    # Reshape to long format, one row per (population, sample) in the same order pd.melt would produce
+    n_samples = len(df)
+    # Population is built as a categorical straight from codes, so later grouping and
+    # pivoting by population compares small ints rather than strings
+    population_codes = np.repeat(POPULATION_CODES, n_samples)
+    long_data = {
+        'sample': np.tile(df['sample_id'].to_numpy(), N_POPULATIONS),
+        'total_count': np.tile(totals, N_POPULATIONS),
+        'population': pd.Categorical.from_codes(population_codes, dtype=POPULATION_DTYPE),
+        'count': counts.ravel(order='F'),
+        'percentage': pct.ravel(order='F')
+    }
+    for col in extra_id_vars:
+        long_data[col] = np.tile(df[col].to_numpy(), N_POPULATIONS)
+    return pd.DataFrame(long_data)
 
 def compare_responders(df):
     """
     Filters data for Melamona/Miraclib/PBMC and compares responders vs non-responders.
     """
     # Filter data
-    filtered_df = df[
+    mask = (
         (df['condition'] == 'melanoma') &
         (df['treatment'] == 'miraclib') &
         (df['sample_type'] == 'PBMC') &
         (df['response'].isin(['yes', 'no']))
-    ].copy()
-    
-    # Calculate frequencies for the filtered data. This returns a df with a 'sample' column.
-    freq_df = calculate_frequencies(filtered_df)
+    )
+    # Only take the columns we read; nothing downstream mutates the slice, so no .copy() is needed
+    filtered_df = df.loc[mask, ['sample_id', 'response'] + CELL_POPULATIONS]
     
-    # --- THIS IS THE CORRECTED LINE ---
-    # Merge the frequency data with the original response data.
-    # Use left_on='sample' for freq_df and right_on='sample_id' for the main df.
-    full_freq_df = pd.merge(
-        freq_df, 
-        df[['sample_id', 'response']],  # Correctly select 'sample_id'
-        left_on='sample', 
-        right_on='sample_id'
-    ).drop(columns='sample_id') # Drop the redundant column after merge
+    # Calculate frequencies for the filtered data, carrying 'response' through to the long format
+    full_freq_df = calculate_frequencies(filtered_df, extra_id_vars=['response'])
     
-    # --- THE REST OF THE FUNCTION REMAINS THE SAME ---
+    # Pivot back to wide (sample x population) so every population is tested in one call.
+    # This scales to larger panels without a per-population loop to parallelise.
+    # reindex keeps every population column even when the cohort is empty
+    wide = (
+        full_freq_df.pivot(index=['sample', 'response'], columns='population', values='percentage')
+        .reindex(columns=CELL_POPULATIONS)
+        .reset_index()
+    )
+    responders = wide.loc[wide['response'] == 'yes', CELL_POPULATIONS].to_numpy()
+    non_responders = wide.loc[wide['response'] == 'no', CELL_POPULATIONS].to_numpy()
     
-    # Perform t-test for each population
-    results = []
-    for pop in CELL_POPULATIONS:
-        pop_data = full_freq_df[full_freq_df['population'] == pop]
-        responders = pop_data[pop_data['response'] == 'yes']['percentage']
-        non_responders = pop_data[pop_data['response'] == 'no']['percentage']
-        
-        if len(responders) > 1 and len(non_responders) > 1:
-            t_stat, p_value = ttest_ind(responders, non_responders, equal_var=False, nan_policy='omit')
-            results.append({
-                'Population': pop,
-                'T-statistic': t_stat,
-                'P-value': p_value,
-                'Significant (p<0.05)': p_value < 0.05
-            })
+    results = {}
+    if len(responders) > 1 and len(non_responders) > 1:
+        t_stats, p_values = ttest_ind(responders, non_responders, axis=0, equal_var=False, nan_policy='omit')
+        results = {
+            'Population': CELL_POPULATIONS,
+            'T-statistic': np.asarray(t_stats),
+            'P-value': np.asarray(p_values),
+            'Significant (p<0.05)': np.asarray(p_values) < 0.05
+        }
 
     stats_df = pd.DataFrame(results)
     return full_freq_df, stats_df
 
+def summarize_boxplot(df):
+    """
+    Computes per (response, population) box statistics: quartiles plus Tukey fences
+    (the most extreme values within 1.5 x IQR of the quartiles), matching Plotly's defaults.
+    Quartiles use the Hazen method, which is what Plotly's default quartilemethod='linear' computes.
+    """
+    keys = ['response', 'population']
+    grouped = df.groupby(keys, observed=True, sort=False)['percentage']
+    summary = grouped.agg(
+        q1=lambda s: np.quantile(s.to_numpy(), 0.25, method='hazen'),
+        median='median',
+        q3=lambda s: np.quantile(s.to_numpy(), 0.75, method='hazen')
+    )
+    
+    bounds = df[keys + ['percentage']].join(summary, on=keys)
+    iqr = bounds['q3'] - bounds['q1']
+    within = bounds[
+        (bounds['percentage'] >= bounds['q1'] - 1.5 * iqr) &
+        (bounds['percentage'] <= bounds['q3'] + 1.5 * iqr)
+    ]
+    fences = within.groupby(keys, observed=True, sort=False)['percentage'].agg(lowerfence='min', upperfence='max')
+    return summary.join(fences).reset_index()
+
 def create_boxplot(df):
-    """Generates an interactive boxplot comparing responders and non-responders."""
-    fig = px.box(
-        df, 
-        x='population', 
-        y='percentage', 
-        color='response',
+    """
+    Generates an interactive boxplot comparing responders and non-responders.
+    
+    Box statistics are precomputed, so only one box per group is sent to the browser
+    rather than every sample. Outlier points are therefore not drawn.
+    """
+    summary = summarize_boxplot(df)
+    colors = {'yes': 'blue', 'no': 'red'}
+    
+    fig = go.Figure()
+    for response in pd.unique(df['response']):
+        group = summary[summary['response'] == response]
+        fig.add_trace(go.Box(
+            x=group['population'].astype(str),
+            q1=group['q1'],
+            median=group['median'],
+            q3=group['q3'],
+            lowerfence=group['lowerfence'],
+            upperfence=group['upperfence'],
+            name=response,
+            marker_color=colors.get(response)
+        ))
+    fig.update_layout(
         title='Cell Population Frequencies: Responders vs. Non-Responders',
-        labels={
-            'percentage': 'Relative Frequency (%)',
-            'population': 'Cell Population',
-            'response': 'Response to Miraclib'
-        },
-        color_discrete_map={'yes': 'blue', 'no': 'red'}
+        boxmode='group',
+        legend_title_text='Response to Miraclib',
+        xaxis_title="Immune Cell Population",
+        yaxis_title="Relative Frequency (%)"
     )
-    fig.update_layout(xaxis_title="Immune Cell Population", yaxis_title="Relative Frequency (%)")
     return fig
 
+def observed_value_counts(series):
+    """
+    Equivalent of value_counts() computed as a bincount over categorical codes.
+    Levels with no rows in the series are left out.
+    """
+    values = series.astype('category')  # no-op for columns that are already categorical
+    codes = values.cat.codes.to_numpy()
+    counts = np.bincount(codes[codes >= 0], minlength=len(values.cat.categories))
+    result = pd.Series(counts, index=pd.Index(values.cat.categories, name=series.name), name='count')
+    return result[result > 0].sort_values(ascending=False, kind='stable')
+
 def get_subset_stats(df):
     """
     Filters for baseline melanoma samples on miraclib and computes summary stats.
     """
-    subset_df = df[
+    mask = (
         (df['condition'] == 'melanoma') &
         (df['treatment'] == 'miraclib') &
         (df['sample_type'] == 'PBMC') &
         (df['time_from_treatment_start'] == 0)
-    ].copy()
+    )
+    subset_df = df.loc[mask, ['subject_id', 'project', 'response', 'sex']]
     
-    # To count subjects correctly, drop duplicate subject IDs
-    unique_subjects_df = subset_df.drop_duplicates(subset=['subject_id'])
+    # To count subjects correctly, drop duplicate subject IDs. When the rows are already
+    # sorted by subject (as returned by database.get_baseline_subset) duplicates are
+    # adjacent, so comparing neighbours is enough and avoids hashing every ID.
+    subject_ids = subset_df['subject_id']
+    if subject_ids.is_monotonic_increasing:
+        ids = subject_ids.to_numpy()
+        first = np.ones(len(ids), dtype=bool)
+        first[1:] = ids[1:] != ids[:-1]
+        unique_subjects_df = subset_df[first]
+    else:
+        unique_subjects_df = subset_df.drop_duplicates(subset=['subject_id'])
     
-    project_counts = subset_df['project'].value_counts()
-    responder_counts = unique_subjects_df['response'].value_counts()
-    gender_counts = unique_subjects_df['sex'].value_counts()
+    project_counts = observed_value_counts(subset_df['project'])
+    responder_counts = observed_value_counts(unique_subjects_df['response'])
+    gender_counts = observed_value_counts(unique_subjects_df['sex'])
     
     return {
         "project_counts": project_counts,
@@ -1,5 +1,8 @@
 # app.py
+import io
+import os
 import streamlit as st
+import numpy as np
 import pandas as pd
 import database
 import analysis
@@ -10,6 +13,32 @@ st.set_page_config(layout="wide", page_title="Loblaw Bio - Cytometry Analysis")
 if 'db_initialized' not in st.session_state:
     st.session_state.db_initialized = False
 
+# --- Cached Data Loading ---
+# Each loader takes the DB files' (mtime, size) so the cache is only invalidated
+# when the database actually changes, not on every widget interaction.
+def get_db_version():
+    """Return a cheap fingerprint of the database file and its write-ahead log."""
+    version = []
+    for path in (database.DB_FILE, database.DB_FILE + "-wal"):
+        try:
+            stat = os.stat(path)
+            version.append((stat.st_mtime_ns, stat.st_size))
+        except OSError:
+            version.append(None)
+    return tuple(version)
+
+@st.cache_data
+def load_frequencies(db_version):
+    return analysis.calculate_frequencies(database.get_full_dataset())
+
+@st.cache_data
+def load_responder_comparison(db_version):
+    return analysis.compare_responders(database.get_responder_subset())
+
+@st.cache_data
+def load_subset_stats(db_version):
+    return analysis.get_subset_stats(database.get_baseline_subset())
+
 # --- UI ---
 st.title("📊 Cytometry Data Analysis for Loblaw Bio")
 st.write("An interactive tool to analyze clinical trial immune cell data.")
@@ -20,10 +49,10 @@ with st.sidebar:
     
     if st.button("Initialize/Reload Database from CSV", key="init_db"):
         with st.spinner("Loading data..."):
-            conn = database.create_connection()
+            conn = database.get_conn()
             database.create_tables(conn)
             message = database.load_data_from_csv(conn)
-            conn.close()
+            st.cache_data.clear()
             st.session_state.db_initialized = True
             st.success(message)
 
@@ -87,6 +116,7 @@ with st.sidebar:
                     with st.spinner("Adding sample..."):
                         add_status = database.add_sample(sample_data)
                         if "Success" in add_status:
+                            st.cache_data.clear()
                             st.success(add_status)
                             st.rerun() # This is key to automatically updating the app
                         else:
@@ -100,6 +130,7 @@ with st.sidebar:
             if remove_id:
                 rows_deleted = database.remove_sample(remove_id)
                 if rows_deleted > 0:
+                    st.cache_data.clear()
                     st.success(f"Removed sample '{remove_id}'.")
                     st.rerun() # Rerun to reflect the deletion
                 else:
@@ -111,24 +142,27 @@ with st.sidebar:
 if not st.session_state.db_initialized:
     st.info("Please initialize the database using the button in the sidebar to begin analysis.")
 else:
-    # Load data for all analyses
-    full_data = database.get_full_dataset()
+    # Every loader below is cached on this fingerprint of the database
+    db_version = get_db_version()
 
     # Part 2: Initial Analysis - Data Overview
     st.header("Part 2: Cell Population Frequency Overview")
     with st.spinner("Calculating frequencies..."):
-        frequency_df = analysis.calculate_frequencies(full_data)
+        frequency_df = load_frequencies(db_version)
     
-    st.write(f"This table shows the relative frequency of each cell population for **{full_data['sample_id'].nunique()}** samples.")
+    st.write(f"This table shows the relative frequency of each cell population for **{frequency_df['sample'].nunique()}** samples.")
     st.dataframe(frequency_df)
 
+    # The leading underscore tells Streamlit not to hash the frame; db_version already identifies it
     @st.cache_data
-    def convert_df_to_csv(df):
-        return df.to_csv(index=False).encode('utf-8')
+    def convert_df_to_csv(db_version, _df):
+        buf = io.BytesIO()
+        _df.to_csv(buf, index=False, encoding='utf-8')
+        return buf.getvalue()
 
     st.download_button(
         label="Download Frequency Data as CSV",
-        data=convert_df_to_csv(frequency_df),
+        data=convert_df_to_csv(db_version, frequency_df),
         file_name='cell_population_frequencies.csv',
         mime='text/csv',
     )
@@ -139,18 +173,22 @@ else:
     st.write("Comparing cell population frequencies in melanoma patients treated with miraclib.")
     
     with st.spinner("Running statistical analysis..."):
-        responder_freq_df, stats_df = analysis.compare_responders(full_data)
+        responder_freq_df, stats_df = load_responder_comparison(db_version)
         boxplot_fig = analysis.create_boxplot(responder_freq_df)
 
     st.plotly_chart(boxplot_fig, use_container_width=True)
+    st.caption("Boxes are drawn from precomputed quartiles; whiskers extend to the most extreme values within 1.5 × IQR. Individual outlier points are not shown.")
     
     st.subheader("Statistical Significance (Welch's t-test)")
     st.write("A t-test is used to compare the means of the two groups (responders vs. non-responders). A low p-value (typically < 0.05) suggests a significant difference between the groups.")
     
-    def highlight_significant(s):
-        return ['background-color: #90EE90']*len(s) if s['Significant (p<0.05)'] else ['']*len(s)
+    def highlight_significant(df):
+        # Build the whole CSS matrix at once: highlight every cell of a significant row
+        mask = df['Significant (p<0.05)'].to_numpy(dtype=bool)
+        css = np.where(mask[:, None], 'background-color: #90EE90', '')
+        return pd.DataFrame(np.broadcast_to(css, df.shape), index=df.index, columns=df.columns)
 
-    st.dataframe(stats_df.style.apply(highlight_significant, axis=1))
+    st.dataframe(stats_df.style.apply(highlight_significant, axis=None))
     
     significant_pops = stats_df[stats_df['Significant (p<0.05)']]['Population'].tolist()
     if significant_pops:
@@ -164,7 +202,7 @@ else:
     st.write("Analysis of baseline (Day 0) Melanoma PBMC samples from patients treated with Miraclib.")
     
     with st.spinner("Analyzing data subset..."):
-        subset_stats = analysis.get_subset_stats(full_data)
+        subset_stats = load_subset_stats(db_version)
 
     col1, col2, col3 = st.columns(3)
     with col1:
@@ -1,21 +1,54 @@
 # database.py
 
 import sqlite3
+import threading
 import pandas as pd
 
 DB_FILE = "trial_data.db"
 
+# Shared connection reused by every query, see get_conn()
+_conn = None
+# Every Streamlit session thread uses the same connection, so each execute/commit/rollback
+# sequence holds this lock to keep one session from committing or rolling back another's
+# half-done transaction. Reentrant so a function holding it can call another that takes it.
+_lock = threading.RLock()
+
+# SQL for add_sample/remove_sample, kept together at module level for readability
+REMOVE_SAMPLE_SQL = 'DELETE FROM samples WHERE sample_id = ?'
+ADD_SUBJECT_SQL = ''' INSERT OR IGNORE INTO subjects(subject_id, project, age, sex, condition)
+                      VALUES(?,?,?,?,?) '''
+ADD_SAMPLE_SQL = ''' INSERT INTO samples(sample_id, subject_id, treatment, response, sample_type, 
+                                        time_from_treatment_start, b_cell, cd8_t_cell, cd4_t_cell, 
+                                        nk_cell, monocyte)
+                     VALUES(?,?,?,?,?,?,?,?,?,?,?) '''
+
 def create_connection():
     """Create a database connection to the SQLite database."""
     conn = None
     try:
-        conn = sqlite3.connect(DB_FILE, timeout=10) # Added timeout for robustness
+        # check_same_thread=False lets the connection be shared across Streamlit's script threads
+        conn = sqlite3.connect(DB_FILE, timeout=10, check_same_thread=False) # Added timeout for robustness
+        # WAL with synchronous=NORMAL only fsyncs at checkpoints rather than on every commit
+        conn.execute("PRAGMA journal_mode=WAL;")
+        conn.execute("PRAGMA synchronous=NORMAL;")
+        conn.execute("PRAGMA temp_store=MEMORY;")
     except sqlite3.Error as e:
         print(e)
     return conn
 
-def create_tables(conn):
-    """Create tables from the schema."""
+def get_conn():
+    """Return the shared database connection, creating it on first use."""
+    global _conn
+    with _lock:
+        if _conn is None:
+            _conn = create_connection()
+    return _conn
+
+def create_schema(conn):
+    """
+    Execute the schema DDL (tables and indexes) without committing,
+    so it can run inside a caller's transaction.
+    """
     subject_table_sql = """
     CREATE TABLE IF NOT EXISTS subjects (
         subject_id TEXT PRIMARY KEY,
@@ -41,13 +74,27 @@ def create_tables(conn):
         FOREIGN KEY (subject_id) REFERENCES subjects (subject_id)
     );
     """
-    try:
-        c = conn.cursor()
-        c.execute(subject_table_sql)
-        c.execute(sample_table_sql)
-        conn.commit()
-    except sqlite3.Error as e:
-        print(f"Error creating tables: {e}")
+    c = conn.cursor()
+    c.execute(subject_table_sql)
+    c.execute(sample_table_sql)
+    # Indexes on the columns used to filter the analysis subsets
+    c.execute("CREATE INDEX IF NOT EXISTS idx_samples_tt ON samples(treatment, sample_type);")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_subjects_cond ON subjects(condition);")
+
+def create_tables(conn):
+    """Create tables from the schema."""
+    with _lock:
+        try:
+            create_schema(conn)
+            conn.commit()
+        except sqlite3.Error as e:
+            conn.rollback()
+            print(f"Error creating tables: {e}")
+
+def missing_primary_key(conn, table):
+    """True if the table exists but has no primary key, as left behind by the old to_sql() loader."""
+    columns = conn.execute(f"PRAGMA table_info({table})").fetchall()
+    return bool(columns) and not any(col[5] for col in columns)
 
 def load_data_from_csv(conn, csv_filepath='data/cell-count.csv'):
     """Load data from CSV file into the SQLite database."""
@@ -62,55 +109,111 @@ def load_data_from_csv(conn, csv_filepath='data/cell-count.csv'):
         samples_df = df.rename(columns={'sample': 'sample_id', 'subject': 'subject_id'})
         samples_df = samples_df.drop(columns=['project', 'age', 'sex', 'condition'])
 
-        subjects_df.to_sql('subjects', conn, if_exists='replace', index=False)
-        samples_df.to_sql('samples', conn, if_exists='replace', index=False)
-        conn.commit()
+        subject_cols = ['subject_id', 'project', 'age', 'sex', 'condition']
+        sample_cols = [
+            'sample_id', 'subject_id', 'treatment', 'response', 'sample_type',
+            'time_from_treatment_start', 'b_cell', 'cd8_t_cell', 'cd4_t_cell',
+            'nk_cell', 'monocyte'
+        ]
+        subject_sql = f"INSERT INTO subjects({', '.join(subject_cols)}) VALUES({', '.join('?' * len(subject_cols))})"
+        sample_sql = f"INSERT INTO samples({', '.join(sample_cols)}) VALUES({', '.join('?' * len(sample_cols))})"
+
+        # Empty and refill the existing tables in a single transaction, keeping the declared schema and indexes
+        with _lock:
+            with conn:
+                conn.execute("BEGIN")
+                # Databases built by the old to_sql(if_exists='replace') loader have keyless tables
+                # that CREATE TABLE IF NOT EXISTS won't touch, so rebuild them from the schema
+                if missing_primary_key(conn, 'subjects') or missing_primary_key(conn, 'samples'):
+                    conn.execute("DROP TABLE IF EXISTS samples")
+                    conn.execute("DROP TABLE IF EXISTS subjects")
+                    create_schema(conn)
+                conn.execute("DELETE FROM samples")
+                conn.execute("DELETE FROM subjects")
+                conn.executemany(subject_sql, subjects_df[subject_cols].itertuples(index=False, name=None))
+                conn.executemany(sample_sql, samples_df[sample_cols].itertuples(index=False, name=None))
         return f"Successfully loaded {len(df)} rows from {csv_filepath}."
     except Exception as e:
         return f"Error loading data: {e}"
 
-def get_full_dataset():
-    """Query and join tables to get the full dataset as a DataFrame."""
-    conn = create_connection()
+# Columns downcast after reading, to cut memory and speed up the analysis filters
+INTEGER_COLUMNS = [
+    'b_cell', 'cd8_t_cell', 'cd4_t_cell', 'nk_cell', 'monocyte',
+    'age', 'time_from_treatment_start'
+]
+CATEGORICAL_COLUMNS = ['condition', 'treatment', 'sample_type', 'response', 'sex', 'project']
+
+def optimize_dtypes(df):
+    """Downcast integer columns and convert low-cardinality text columns to categoricals."""
+    for col in INTEGER_COLUMNS:
+        if col in df:
+            df[col] = pd.to_numeric(df[col], downcast='integer')
+    for col in CATEGORICAL_COLUMNS:
+        if col in df:
+            df[col] = df[col].astype('category')
+    return df
+
+DATASET_QUERY = """
+SELECT
+    s.*,
+    sub.project,
+    sub.age,
+    sub.sex,
+    sub.condition
+FROM samples s
+JOIN subjects sub ON s.subject_id = sub.subject_id
+"""
+
+def query_dataset(where="", params=(), order_by=""):
+    """Run the joined dataset query, optionally restricted by a parameterized WHERE clause and sorted."""
+    conn = get_conn()
     if conn is None:
         return pd.DataFrame()
         
-    query = """
-    SELECT
-        s.*,
-        sub.project,
-        sub.age,
-        sub.sex,
-        sub.condition
-    FROM samples s
-    JOIN subjects sub ON s.subject_id = sub.subject_id
-    """
-    try:
-        df = pd.read_sql_query(query, conn)
-    except Exception as e:
-        print(f"Error fetching data: {e}")
-        df = pd.DataFrame()
-    finally:
-        if conn:
-            conn.close()
+    query = DATASET_QUERY + (f"WHERE {where}" if where else "") + (f"\nORDER BY {order_by}" if order_by else "")
+    with _lock:
+        try:
+            df = optimize_dtypes(pd.read_sql_query(query, conn, params=params))
+        except Exception as e:
+            print(f"Error fetching data: {e}")
+            df = pd.DataFrame()
     return df
 
+def get_full_dataset():
+    """Query and join tables to get the full dataset as a DataFrame."""
+    return query_dataset()
+
+def get_responder_subset(condition='melanoma', treatment='miraclib', sample_type='PBMC'):
+    """Get samples with a yes/no response for the given condition, treatment and sample type."""
+    where = """
+    sub.condition = ? AND s.treatment = ? AND s.sample_type = ?
+    AND s.response IN ('yes', 'no')
+    """
+    return query_dataset(where, (condition, treatment, sample_type))
+
+def get_baseline_subset(condition='melanoma', treatment='miraclib', sample_type='PBMC'):
+    """Get baseline (time_from_treatment_start = 0) samples for the given condition, treatment and sample type."""
+    where = """
+    sub.condition = ? AND s.treatment = ? AND s.sample_type = ?
+    AND s.time_from_treatment_start = 0
+    """
+    # Sorted by subject so duplicate subjects are adjacent, see analysis.get_subset_stats
+    return query_dataset(where, (condition, treatment, sample_type), order_by="s.subject_id, s.sample_id")
+
 def remove_sample(sample_id):
     """Remove a sample by its ID."""
-    conn = create_connection()
+    conn = get_conn()
     if not conn: return 0
-    sql = 'DELETE FROM samples WHERE sample_id = ?'
-    cur = conn.cursor()
-    try:
-        cur.execute(sql, (sample_id,))
-        conn.commit()
-        rows_deleted = cur.rowcount
-    except sqlite3.Error as e:
-        print(f"Error removing sample: {e}")
-        rows_deleted = 0
-    finally:
-        if conn:
-            conn.close()
+    with _lock:
+        cur = conn.cursor()
+        try:
+            cur.execute(REMOVE_SAMPLE_SQL, (sample_id,))
+            conn.commit()
+            rows_deleted = cur.rowcount
+        except sqlite3.Error as e:
+            print(f"Error removing sample: {e}")
+            conn.rollback()
+            rows_deleted = 0
     return rows_deleted
 
 # --- NEW FUNCTION TO ADD A SAMPLE ---
@@ -124,37 +227,32 @@ def add_sample(data):
     Returns:
         str: A message indicating success or failure.
     """
-    conn = create_connection()
+    conn = get_conn()
     if not conn: return "Error: Could not connect to the database."
     
-    try:
-        cur = conn.cursor()
+    with _lock:
+        try:
+            cur = conn.cursor()
         
-        # Step 1: Add the subject. 'INSERT OR IGNORE' prevents errors if the subject already exists.
-        # This is an atomic and safe way to handle existing subjects.
-        subject_sql = ''' INSERT OR IGNORE INTO subjects(subject_id, project, age, sex, condition)
-                          VALUES(?,?,?,?,?) '''
-        cur.execute(subject_sql, (data['subject_id'], data['project'], data['age'], data['sex'], data['condition']))
+            # Step 1: Add the subject. 'INSERT OR IGNORE' prevents errors if the subject already exists.
+            # This is an atomic and safe way to handle existing subjects.
+            cur.execute(ADD_SUBJECT_SQL, (data['subject_id'], data['project'], data['age'], data['sex'], data['condition']))
         
-        # Step 2: Add the sample. This will fail if sample_id is not unique.
-        sample_sql = ''' INSERT INTO samples(sample_id, subject_id, treatment, response, sample_type, 
-                                            time_from_treatment_start, b_cell, cd8_t_cell, cd4_t_cell, 
-                                            nk_cell, monocyte)
-                         VALUES(?,?,?,?,?,?,?,?,?,?,?) '''
-        cur.execute(sample_sql, (
-            data['sample_id'], data['subject_id'], data['treatment'], data['response'], 
-            data['sample_type'], data['time_from_treatment_start'], data['b_cell'], 
-            data['cd8_t_cell'], data['cd4_t_cell'], data['nk_cell'], data['monocyte']
-        ))
+            # Step 2: Add the sample. This will fail if sample_id is not unique.
+            cur.execute(ADD_SAMPLE_SQL, (
+                data['sample_id'], data['subject_id'], data['treatment'], data['response'], 
+                data['sample_type'], data['time_from_treatment_start'], data['b_cell'], 
+                data['cd8_t_cell'], data['cd4_t_cell'], data['nk_cell'], data['monocyte']
+            ))
         
-        conn.commit()
-        return f"Success: Sample '{data['sample_id']}' for subject '{data['subject_id']}' has been added."
+            conn.commit()
+            return f"Success: Sample '{data['sample_id']}' for subject '{data['subject_id']}' has been added."
 
-    except sqlite3.IntegrityError:
-        # This error is raised if the sample_id (PRIMARY KEY) already exists.
-        return f"Error: Sample ID '{data['sample_id']}' already exists. Please use a unique ID."
-    except Exception as e:
-        return f"An unexpected error occurred: {e}"
-    finally:
-        if conn:
-            conn.close()
\ No newline at end of file
+        except sqlite3.IntegrityError:
+            # This error is raised if the sample_id (PRIMARY KEY) already exists.
+            # Roll back so the shared connection isn't left holding the subject insert.
+            conn.rollback()
+            return f"Error: Sample ID '{data['sample_id']}' already exists. Please use a unique ID."
+        except Exception as e:
+            conn.rollback()
+            return f"An unexpected error occurred: {e}"
\ No newline at end of file